@@ -0,0 +1,51 @@
+import numpy as np
+import shapely  # type: ignore
+from pyproj import Geod  # type: ignore
+from shapely.geometry.base import BaseGeometry  # type: ignore
+
+# Radius of the sphere with the same surface area as the WGS84 ellipsoid
+AUTHALIC_RADIUS = 6371007.180918475
+WGS84_GEOD = Geod(ellps="WGS84")
+
+
+def round_coordinates(geoms: np.ndarray, precision: int) -> np.ndarray:
+    # Round the coordinates of all geometries in one NumPy call
+    return shapely.transform(geoms, lambda coords: np.round(coords, precision))
+
+
+def ring_area(coords: np.ndarray) -> float:
+    # Spherical excess of a closed ring of (lon, lat) degrees, in square meters
+    lon = np.radians(coords[:, 0])
+    sin_lat = np.sin(np.radians(coords[:, 1]))
+    excess = np.sum((lon[1:] - lon[:-1]) * (sin_lat[:-1] + sin_lat[1:]))
+
+    return abs(excess) * AUTHALIC_RADIUS**2 / 2.0
+
+
+def min_geodesic_area(geoms: np.ndarray) -> np.ndarray:
+    # Cheap lower bound of geodesic_area from the planar area in degrees, taking
+    # cos(lat) at the latitude farthest from the equator. Within about 1% of
+    # the ellipsoidal area, like geodesic_area.
+    bounds = shapely.bounds(geoms)
+    max_lat = np.maximum(np.abs(bounds[..., 1]), np.abs(bounds[..., 3]))
+    scale = np.radians(1) ** 2 * np.cos(np.radians(max_lat))
+
+    return shapely.area(geoms) * scale * AUTHALIC_RADIUS**2
+
+
+def geodesic_area(geom: BaseGeometry) -> float:
+    if hasattr(geom, "geoms"):
+        return sum(geodesic_area(g) for g in geom.geoms)
+    elif geom.geom_type != "Polygon" or geom.is_empty:
+        return 0.0
+
+    area = ring_area(np.asarray(geom.exterior.coords))
+    for interior in geom.interiors:
+        area -= ring_area(np.asarray(interior.coords))
+
+    return area
+
+
+def ellipsoidal_area(geom: BaseGeometry) -> float:
+    # Exact WGS84 area through PROJ; much slower than geodesic_area
+    return abs(WGS84_GEOD.geometry_area_perimeter(geom)[0])
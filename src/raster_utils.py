@@ -1,8 +1,8 @@
 from math import ceil
 from pathlib import Path
-from typing import Iterator, List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 
-import numba as nb  # type: ignore
+import numpy as np
 import rasterio  # type: ignore
 from rasterio import transform  # type: ignore
 from rasterio.profiles import Profile  # type: ignore
@@ -10,23 +10,16 @@ from rasterio.windows import Window  # type: ignore
 
 
 class ImageStackMetadata:
-    source_images: List[Union[str, Path]]
+    source_image: Union[str, Path]  # multi-band VRT of the images to stack
     profile: Profile
     x_read_offset: int = 0
     y_read_offset: int = 0
-    read_windows: Union[Iterator[Window], List[Window]]
-    write_windows: Union[Iterator[Window], List[Window]]
+    block_size: int = 256
+    read_windows: np.ndarray
+    write_windows: np.ndarray
 
 
-@nb.jit(nopython=True)
-def values_check(array):
-    for x in array.flat:
-        if x:
-            return True
-    return False
-
-
-def get_windows(  # noqa: C901
+def get_windows(
     width: int,
     height: int,
     size: int = 256,
@@ -34,113 +27,127 @@ def get_windows(  # noqa: C901
         0,
         0,
     ),
-) -> Iterator[Window]:
-    num_windows_w = int(ceil(width * 1.0 / size))
-    num_windows_h = int(ceil(height * 1.0 / size))
-    offset_x = None
-    offset_y = 0
-
-    for _ in range(num_windows_h):
-        offset_x = 0
-        for _ in range(num_windows_w):
-            if offset_x > width:
-                size_w = width
-            elif offset_x + size < width:
-                size_w = size
-            else:
-                size_w = width - offset_x
-
-            if offset_y > height:
-                size_h = height
-            elif offset_y + size < height:
-                size_h = size
-            else:
-                size_h = height - offset_y
-            yield Window(offset_x + offset[0], offset_y + offset[1], size_w, size_h)
+) -> np.ndarray:
+    xs = np.arange(0, width, size, dtype=np.int32)
+    ys = np.arange(0, height, size, dtype=np.int32)
+    col_offs, row_offs = np.meshgrid(xs + offset[0], ys + offset[1])
+    widths, heights = np.meshgrid(
+        np.minimum(size, width - xs), np.minimum(size, height - ys)
+    )
 
-            offset_x = offset_x + size
-        offset_y = offset_y + size
+    # One (col_off, row_off, width, height) row per window
+    return np.stack(
+        [col_offs.ravel(), row_offs.ravel(), widths.ravel(), heights.ravel()], axis=1
+    )
 
 
 def stack_images(  # noqa: C901
     image_stack_metadata: ImageStackMetadata,
     output_path: Union[str, Path],
-) -> Union[None, Path]:
-
-    image_paths = image_stack_metadata.source_images
-
-    if len(image_paths) == 0:
-        return None
-    elif len(image_paths) == 1:
-        return Path(image_paths[0])
-
-    image0 = rasterio.open(image_paths[0], "r")
-
+    num_threads: Union[int, str] = "ALL_CPUS",
+) -> Path:
     profile = image_stack_metadata.profile
+    num_bands = profile["count"]
 
+    profile["driver"] = "GTiff"
     profile["tiled"] = True
-    profile["blockxsize"] = 1024
-    profile["blockysize"] = 1024
+    profile["blockxsize"] = image_stack_metadata.block_size
+    profile["blockysize"] = image_stack_metadata.block_size
     profile["nodata"] = 0
     profile["dtype"] = rasterio.uint8
-    profile["count"] = len(image_paths)
-    profile["compress"] = "deflate"
+    profile["compress"] = "zstd"
+    profile["zstd_level"] = "3"
     profile["predictor"] = "2"
-    profile["ZLEVEL"] = "9"
-    profile["num_threads"] = "1"
-
-    output_image = rasterio.open(output_path, "w", **profile)
-    image_datasets = [image0]
-    image_datasets.extend([rasterio.open(ip, "r") for ip in image_paths[1:]])
-
-    windows = zip(image_stack_metadata.read_windows, image_stack_metadata.write_windows)
-    for window, write_window in windows:
-        for n, image_dataset in enumerate(image_datasets):
-            chunk = image_dataset.read(window=window, indexes=1)
-            if values_check(chunk) is False:
+    # Band-separated VRTs carry no interleave, and GTiff would default to pixel
+    # interleaving, which stores every band in each block
+    profile["interleave"] = "band"
+    profile["num_threads"] = str(num_threads)
+
+    # Keep every source image of the VRT open at once, without listing the
+    # images directory each time one is opened
+    with rasterio.Env(
+        GDAL_MAX_DATASET_POOL_SIZE=num_bands + 1,
+        GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    ):
+        output_image = rasterio.open(output_path, "w", **profile)
+        source_image = rasterio.open(image_stack_metadata.source_image, "r")
+
+        # Read buffers are reused across windows, keyed by (height, width) so
+        # edge windows get their own contiguous buffer.
+        buffers: Dict[Tuple[int, int], np.ndarray] = dict()
+        windows = zip(
+            image_stack_metadata.read_windows, image_stack_metadata.write_windows
+        )
+        for window_row, write_window_row in windows:
+            col_off, row_off, width, height = window_row.tolist()
+            if (height, width) not in buffers:
+                buffers[(height, width)] = np.zeros(
+                    (num_bands, height, width), dtype=np.uint8
+                )
+            buf = buffers[(height, width)]
+
+            # All bands of the window in one read
+            source_image.read(window=Window(col_off, row_off, width, height), out=buf)
+
+            mask = buf.any(axis=(1, 2))
+            if not mask.any():
                 continue
-            output_image.write(chunk, window=write_window, indexes=n + 1)
 
-    for image_dataset in image_datasets:
-        image_dataset.close()
-        image_dataset = None
+            # One write per window for all non-empty bands
+            write_window = Window(*write_window_row.tolist())
+            if mask.all():
+                output_image.write(buf, window=write_window)
+            else:
+                output_image.write(
+                    buf[mask],
+                    window=write_window,
+                    indexes=(np.flatnonzero(mask) + 1).tolist(),
+                )
 
-    output_image.close()
-    output_image = None
-    for image_dataset in image_datasets:
-        image_dataset.close()
-        image_dataset = None
+        output_image.close()
+        output_image = None
+        source_image.close()
+        source_image = None
 
     return Path(output_path)
 
 
 def split_image(
-    image_paths: List[Union[str, Path]], num_splits: int, window_size: int = 256
+    image_path: Union[str, Path], num_splits: int, window_size: int = 256
 ) -> List[ImageStackMetadata]:
-    with rasterio.open(image_paths[0], "r") as ds:
+    with rasterio.open(image_path, "r") as ds:
         profile = ds.profile
         if num_splits < 1:
             raise ValueError("num_splits less than 1")
         elif num_splits == 1:
             meta = ImageStackMetadata()
             meta.profile = profile
-            meta.source_images = image_paths
+            meta.source_image = image_path
             meta.x_read_offset = 0
             meta.y_read_offset = 0
-            meta.read_windows = [Window(0, 0, profile["width"], profile["height"])]
+            meta.block_size = window_size
+            meta.read_windows = np.array(
+                [[0, 0, profile["width"], profile["height"]]], dtype=np.int32
+            )
             meta.write_windows = meta.read_windows
             return [meta]
 
         src_transform = ds.profile["transform"]
         width = profile["width"]
         height = profile["height"]
-        split_img_width = abs(ceil(width * 1.0 / num_splits))
+        # Snap split widths to the window grid so that every read and write
+        # lines up with whole blocks; this can leave trailing splits empty.
+        split_img_width = int(ceil(width / num_splits / window_size)) * window_size
         metas = []
         for n in range(num_splits):
+            if split_img_width * n >= width:
+                break
+
             meta = ImageStackMetadata()
-            meta.source_images = image_paths
+            meta.source_image = image_path
             meta.x_read_offset = split_img_width * n
             meta.y_read_offset = 0
+            meta.block_size = window_size
 
             new_profile = profile.copy()
 
@@ -150,27 +157,22 @@ def split_image(
             tf[0] = x
             new_profile["transform"] = transform.Affine.from_gdal(*tf)
 
-            if split_img_width * n > width:
-                new_image_width = width - (split_img_width * (n - 1))
-            else:
-                new_image_width = split_img_width
+            new_image_width = min(split_img_width, width - meta.x_read_offset)
 
             new_profile["width"] = new_image_width
 
-            meta.read_windows = list(
-                get_windows(
-                    width=new_image_width,
-                    height=height,
-                    size=window_size,
-                    offset=(
-                        meta.x_read_offset,
-                        meta.y_read_offset,
-                    ),
-                )
+            meta.read_windows = get_windows(
+                width=new_image_width,
+                height=height,
+                size=window_size,
+                offset=(
+                    meta.x_read_offset,
+                    meta.y_read_offset,
+                ),
             )
 
-            meta.write_windows = list(
-                get_windows(width=new_image_width, height=height, size=window_size)
+            meta.write_windows = get_windows(
+                width=new_image_width, height=height, size=window_size
             )
 
             meta.profile = new_profile
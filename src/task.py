@@ -6,28 +6,48 @@ import multiprocessing
 import os
 import shutil
 import subprocess
-import tarfile
 import threading
 import uuid
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from datetime import date, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional, TextIO, Tuple, Union
-
+from typing import (
+    IO,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from xml.sax.saxutils import escape
+
+import numpy as np
 import requests
+import shapely  # type: ignore
+from google.cloud.storage import transfer_manager  # type: ignore
 from osgeo import gdal, gdalconst  # type: ignore
-from pyproj import Geod  # type: ignore
-from shapely import wkt as shp_wkt  # type: ignore
-from shapely.validation import explain_validity  # type: ignore
 from task_base import HIITask, ConversionException  # type: ignore
 
+import geometry_utils
 import raster_utils
 from timer import Timer
 
-gdal.SetConfigOption("GDAL_CACHEMAX", "512")
 gdal.SetConfigOption("GDAL_SWATH_SIZE", "512")
 gdal.SetConfigOption("GDAL_MAX_DATASET_POOL_SIZE", "400")
 
+PIXEL_SIZE = 0.00269  # in degrees
+
 
 def run_in_thread(fn):
     def run(*k, **kw):
@@ -38,29 +58,116 @@ def run_in_thread(fn):
     return run
 
 
+class _PipeReader:
+    # Resumable uploads track their progress with tell(), which pipes lack. A
+    # pipe cannot seek back either, so a failed chunk cannot be resent and the
+    # whole upload fails instead.
+    def __init__(self, stream: IO[bytes]):
+        self._stream = stream
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._position += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._position
+
+
+def _wait_for_all(
+    futures: List[Future], on_done: Optional[Callable[[Any], Any]] = None
+):
+    # Re-raise the first failure as soon as it happens, without starting the
+    # jobs still queued (Executor.shutdown's cancel_futures needs Python 3.9)
+    for future in as_completed(futures):
+        if future.exception() is not None:
+            for f in futures:
+                f.cancel()
+            future.result()
+        if on_done is not None:
+            on_done(future.result())
+
+
+def _range_validator(headers: Mapping[str, str]) -> str:
+    # Weak ETags cannot be used with If-Range, so Last-Modified is used instead
+    etag = headers.get("ETag", "")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified", "")
+
+
+def _worker_cache_size(num_workers: int) -> int:
+    # Share 60% of the RAM between the workers, in MB
+    total_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**2
+    return max(256, min(2048, int(total_mb * 0.6 / num_workers)))
+
+
+def _init_gdal(cache_size: int, num_workers: int):
+    # A pool of several workers already keeps every core busy, so GDAL itself
+    # stays single threaded unless it is the only worker. The split files
+    # directory holds thousands of files, so GDAL should not list it when
+    # opening each one.
+    gdal.SetConfigOption("GDAL_CACHEMAX", str(cache_size))
+    gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+    gdal.SetConfigOption("GDAL_NUM_THREADS", "1" if num_workers > 1 else "ALL_CPUS")
+    gdal.SetConfigOption("VSI_CACHE", "TRUE")
+
+
 def _rasterize(
-    in_file: Union[str, Path],
+    in_files: Sequence[Union[str, Path]],
     output_path: Union[str, Path],
     output_bounds: List[float],
+    block_size: int = 1024,
 ) -> Path:
+    # Expose every CSV file as a layer of one OGR VRT datasource so that all of
+    # them are burned into the output grid in a single gdal.Rasterize pass.
+    vrt_path = Path(f"{os.path.splitext(output_path)[0]}.vrt")
+    layers = [f"split_{n}" for n in range(len(in_files))]
+    with open(vrt_path, "w") as f:
+        f.write("<OGRVRTDataSource>\n")
+        for layer, in_file in zip(layers, in_files):
+            f.write(
+                f'  <OGRVRTLayer name="{layer}">\n'
+                f"    <SrcDataSource>{escape(str(in_file))}</SrcDataSource>\n"
+                f"    <SrcLayer>{escape(Path(in_file).stem)}</SrcLayer>\n"
+                "  </OGRVRTLayer>\n"
+            )
+        f.write("</OGRVRTDataSource>\n")
+
+    # Burn feature by feature into the blocks they touch; GDAL would otherwise
+    # walk every block of the global grid for tags with few features.
     opts = gdal.RasterizeOptions(
+        options=["-optim", "VECTOR"],
+        layers=layers,
         format="GTiff",
         outputType=gdalconst.GDT_Byte,
         noData=0,
-        initValues=0,
         burnValues=1,
-        xRes=0.00269,
-        yRes=0.00269,
+        xRes=PIXEL_SIZE,
+        yRes=PIXEL_SIZE,
         targetAlignedPixels=True,
         outputSRS="EPSG:4326",
         outputBounds=output_bounds,
+        # Most tags cover a small part of the globe, so blocks left at nodata
+        # are not written at all and need no initValues fill.
         creationOptions=[
             "TILED=YES",
-            "BLOCKXSIZE=1024",
-            "BLOCKYSIZE=1024",
+            f"BLOCKXSIZE={block_size}",
+            f"BLOCKYSIZE={block_size}",
+            "COMPRESS=ZSTD",
+            "ZSTD_LEVEL=3",
+            "PREDICTOR=2",
+            "SPARSE_OK=TRUE",
+            "BIGTIFF=IF_SAFER",
         ],
     )
-    gdal.Rasterize(str(output_path), str(in_file), options=opts)
+    # GDAL reports failures through its error handler rather than exceptions
+    ds = gdal.Rasterize(str(output_path), str(vrt_path), options=opts)
+    os.remove(vrt_path)
+    if ds is None:
+        raise ConversionException(f"Failed to rasterize {output_path}")
+    ds = None
 
     return Path(output_path)
 
@@ -75,7 +182,7 @@ class HIIOSMRasterize(HIITask):
     3.
         a) Split up text file into one CSV file per attribute/tag combination per 1 million rows
         b) Clean geometry and write out road tags to a roads CSV file
-    4. Rasterize each CSV file
+    4. Rasterize the CSV files of each attribute/tag combination into one image
     5. Merge all tiff images into 1 multiband tiff file and split image
     6. Upload to Google Storage
     7. Clean up working directories and files
@@ -89,6 +196,20 @@ class HIIOSMRasterize(HIITask):
     MIN_GEOM_AREA = 5  # in meters
     POLYGON_PRECISION = 5
     MAX_ROWS = 1000000
+    READ_CHUNK_SIZE = 8 * 1024 * 1024  # in bytes
+    WRITE_BUFFER_SIZE = 1024 * 1024  # in bytes, per split file
+    SPLIT_RANGES_PER_WORKER = 4  # text file ranges per split worker
+    MERGE_MAX_ROWS = 100000  # split files with fewer rows are merged per tag
+    SPLIT_FILE_HEADER = b'"WKT","BURN"\n'
+    ROADS_BATCH_SIZE = 10000  # road rows cleaned per batch
+    # Vertices closer than half a pixel do not change the rasterized images
+    SIMPLIFY_TOLERANCE = PIXEL_SIZE / 2
+    DOWNLOAD_CONNECTIONS = 8
+    DOWNLOAD_TIMEOUT = 60  # in seconds, to connect and between received bytes
+    UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024  # in bytes
+    UPLOAD_WORKERS = 8
+    STACK_WINDOW = 512  # rasterized and stacked image block size, in pixels
+    STACK_SPLITS_PER_WORKER = 4  # stacked image strips per stacking worker
     DEFAULT_BUCKET = os.environ.get("HII_OSM_BUCKET", "hii-osm")
 
     def _get_osm_url(self):
@@ -165,42 +286,114 @@ class HIIOSMRasterize(HIITask):
 
         return name
 
+    # Split helpers only rely on class constants so that they can run in worker
+    # processes without pickling the task instance.
+    @classmethod
     def _create_file(
-        self, directory: Union[str, Path], attributes_tag: str
-    ) -> Tuple[Path, TextIO]:
-        name = f"{attributes_tag}_{uuid.uuid4()}.csv"
+        cls, directory: Union[str, Path], attributes_tag: str, file_id: str
+    ) -> Tuple[Path, BinaryIO]:
+        name = f"{attributes_tag}_{file_id}.csv"
         path = Path(directory, name)
-        f = open(path, "w")
-        f.write('"WKT","BURN"\n')
+        f = open(path, "wb")
+        f.write(cls.SPLIT_FILE_HEADER)
         return path, f
 
-    def _parse_row(self, row: str) -> Union[Tuple[str, List[str]], Tuple[None, None]]:
-        idx = row.rindex(")") + 1
-        attr_tags = row[idx + 1 : -1].split(",")
+    @classmethod
+    def _iter_row_blocks(  # noqa: C901
+        cls, txt_file: Union[str, Path], start: int = 0, end: Optional[int] = None
+    ) -> Iterator[List[bytes]]:
+        # Rows in the byte range [start, end) without the trailing newline, one
+        # list per large binary chunk read. start and end must fall on row
+        # boundaries.
+        remainder = b""
+        with open(txt_file, "rb", buffering=0) as fr:
+            if end is None:
+                end = os.fstat(fr.fileno()).st_size
+            # Ask for aggressive readahead over this worker's range only
+            os.posix_fadvise(fr.fileno(), start, end - start, os.POSIX_FADV_SEQUENTIAL)
+            fr.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = fr.read(min(cls.READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+
+                chunk = remainder + chunk
+                last_newline = chunk.rfind(b"\n")
+                if last_newline == -1:
+                    remainder = chunk
+                    continue
 
-        if not attr_tags or not attr_tags[0]:
-            return None, None
+                remainder = chunk[last_newline + 1 :]
+                yield chunk[:last_newline].split(b"\n")
 
-        # wkt, attribute tags
-        return row[0:idx], attr_tags
+        if remainder:
+            yield [remainder]
+
+    @classmethod
+    def _flush_buffer(cls, handle: BinaryIO, buffer: List[bytes]) -> None:
+        handle.write(b"".join(buffer))
+        buffer.clear()
+
+    @classmethod
+    def _parse_rows(cls, rows: List[bytes]) -> List[Tuple[bytes, List[bytes]]]:
+        # Rows are "<wkt> <attribute=tag>,<attribute=tag>,..." and the configured
+        # attribute tags contain no spaces, so the last space ends the WKT. Rows
+        # without attribute tags are dropped.
+        parts = [row.rpartition(b" ") for row in rows]
+
+        return [
+            (wkt, attr_tags.split(b","))
+            for wkt, _, attr_tags in parts
+            if attr_tags and not attr_tags.endswith(b")")
+        ]
+
+    @classmethod
+    def _iter_parsed_rows(
+        cls,
+        txt_file: Union[str, Path],
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> Iterator[Tuple[bytes, List[bytes]]]:
+        # Each block of rows is parsed in list comprehensions and its polygons
+        # are simplified with one vectorized call.
+        for rows in cls._iter_row_blocks(txt_file, start, end):
+            yield from cls._simplify_rows(cls._parse_rows(rows))
+
+    @classmethod
+    def _simplify_rows(
+        cls, rows: List[Tuple[bytes, List[bytes]]]
+    ) -> List[Tuple[bytes, List[bytes]]]:
+        indices = [n for n, (wkt, _) in enumerate(rows) if b"POLYGON" in wkt]
+        if not indices:
+            return rows
+
+        # Topology is preserved so that polygons smaller than the tolerance keep
+        # burning the pixel centers they cover instead of collapsing.
+        geoms = shapely.from_wkt([rows[n][0] for n in indices])
+        geoms = shapely.simplify(geoms, cls.SIMPLIFY_TOLERANCE, preserve_topology=True)
+        # OSM coordinates have 7 decimals
+        wkts = shapely.to_wkt(geoms, rounding_precision=7, trim=True)
+        for n, wkt in zip(indices, wkts):
+            rows[n] = (wkt.encode(), rows[n][1])
+
+        return rows
 
     def _create_image_metadata(
         self,
-        image_paths: List[Union[str, Path]],
+        image_paths: Dict[str, Path],
         output_image_uris: List[str],
         road_uri: str,
         output_file: Union[str, Path],
     ) -> Path:
+        # Images are stacked in the order of image_paths, one band per tag
         bands_metadata: Dict[str, Any] = dict()
-        for n, img_pth in enumerate(image_paths):
-            name = Path(os.path.splitext(img_pth)[0]).name
-            attribute_tag = name.rsplit("_", 1)[0]
-            attribute, tag = attribute_tag.split("=")
-            if attribute_tag not in bands_metadata:
-                bands_metadata[attribute_tag] = dict(
-                    attribute=attribute, tag=tag, bands=[]
-                )
-            bands_metadata[attribute_tag]["bands"].append(n + 1)
+        for n, attribute_tag in enumerate(image_paths):
+            attribute, tag = attribute_tag.split("=", 1)
+            bands_metadata[attribute_tag] = dict(
+                attribute=attribute, tag=tag, bands=[n + 1]
+            )
 
         metadata = dict(
             bands=bands_metadata,
@@ -213,34 +406,76 @@ class HIIOSMRasterize(HIITask):
 
         return Path(output_file)
 
-    def _clean_geometry(  # noqa: C901
-        self, wkt: Optional[str], geod: Geod, fail_fast: bool = False
-    ) -> Optional[str]:
-        if not wkt or "POLYGON" not in wkt:
-            return wkt
-
-        geom = shp_wkt.loads(
-            shp_wkt.dumps(shp_wkt.loads(wkt), rounding_precision=self.POLYGON_PRECISION)
-        ).simplify(0)
-        if geom.is_valid is False:
-            if fail_fast is True:
-                print(f"INVALID [{explain_validity(geom)}] - {geom}")
-                return None
-            # Try validating one more time after attempting to clean with buffer
-            return self._clean_geometry(shp_wkt.dumps(geom.buffer(0)), geod, True)
-        elif geom.is_empty is True:
-            print(f"EMPTY - {geom}")
-            return None
-
-        area = abs(geod.geometry_area_perimeter(geom)[0])
-        if area < self.MIN_GEOM_AREA:
-            print(f"AREA[{area}] - {geom}")
-            return None
+    @classmethod
+    def _clean_geometries(  # noqa: C901
+        cls, wkts: List[bytes]
+    ) -> List[Optional[bytes]]:
+        # Polygons are cleaned in one batch of vectorized GEOS calls, while other
+        # geometries are passed through unchanged.
+        cleaned: List[Optional[bytes]] = list(wkts)
+        indices = [n for n, wkt in enumerate(wkts) if b"POLYGON" in wkt]
+        if not indices:
+            return cleaned
+
+        geoms = shapely.from_wkt([wkts[n] for n in indices])
+        geoms = geometry_utils.round_coordinates(geoms, cls.POLYGON_PRECISION)
+        geoms = shapely.simplify(geoms, 0)
+        invalid = ~shapely.is_valid(geoms)
+        if invalid.any():
+            geoms[invalid] = shapely.make_valid(geoms[invalid])
+            # Drop the lines and points that collapsed parts are repaired into
+            collections = shapely.get_type_id(geoms) == 7
+            geoms[collections] = shapely.buffer(geoms[collections], 0)
+            # Repairs add intersection vertices off the output grid; snap them
+            # so that rounding the WKT cannot make the polygons invalid again
+            geoms[invalid] = shapely.set_precision(
+                geoms[invalid], 10.0**-cls.POLYGON_PRECISION
+            )
 
-        return shp_wkt.dumps(geom, rounding_precision=self.POLYGON_PRECISION)
+        # Most polygons are clearly larger than the threshold from their planar
+        # area alone. The spherical area is within a fraction of a percent of the
+        # ellipsoidal one, so the exact area is only needed close to the threshold.
+        keep = ~shapely.is_empty(geoms)
+        marginal = np.zeros(len(geoms), dtype=bool)
+        marginal[keep] = (
+            geometry_utils.min_geodesic_area(geoms[keep]) < 2 * cls.MIN_GEOM_AREA
+        )
+        for n in np.flatnonzero(marginal):
+            # Clearly smaller polygons are dropped without the PROJ call too
+            area = geometry_utils.geodesic_area(geoms[n])
+            if cls.MIN_GEOM_AREA / 2 <= area < 2 * cls.MIN_GEOM_AREA:
+                area = geometry_utils.ellipsoidal_area(geoms[n])
+            if area < cls.MIN_GEOM_AREA:
+                print(f"AREA[{area}] - {geoms[n]}")
+                keep[n] = False
+        for n in np.flatnonzero(shapely.is_empty(geoms)):
+            print(f"EMPTY - {geoms[n]}")
+
+        out_wkts = shapely.to_wkt(
+            geoms[keep], rounding_precision=cls.POLYGON_PRECISION, trim=True
+        )
+        for index in indices:
+            cleaned[index] = None
+        for kept, wkt in zip(np.flatnonzero(keep), out_wkts):
+            cleaned[indices[kept]] = wkt.encode()
+
+        return cleaned
+
+    @classmethod
+    def _write_roads(
+        cls, roads_file: BinaryIO, wkts: List[bytes], suffixes: List[bytes]
+    ) -> None:
+        lines = [
+            b'"' + wkt + suffix
+            for wkt, suffix in zip(cls._clean_geometries(wkts), suffixes)
+            if wkt is not None
+        ]
+        roads_file.write(b"".join(lines))
+        wkts.clear()
+        suffixes.clear()
 
     @run_in_thread
-    def _backup_step_data(
+    def _backup_step_data(  # noqa: C901
         self, file_paths: Union[str, Path, list], backup_name: Union[str, Path]
     ):
         if self.backup_step_data is False:
@@ -255,24 +490,121 @@ class HIIOSMRasterize(HIITask):
         ):
             file_paths = [file_paths]
 
-        tar_name = f"{backup_name}.tar.gz"
-        backup_path = Path(self._working_directory, tar_name)
-        with tarfile.open(backup_path, "w:gz") as tar:
-            for f in file_paths:
-                tar.add(str(f))
-
-        self.upload_to_cloudstorage(backup_path, tar_name)
+        # tar and zstd run as a pipeline of their own, so this process holds no
+        # write end of a pipe that the worker processes forked in the meantime
+        # would inherit and keep open. zstd compresses on every core, and its
+        # output is streamed straight into a resumable upload, without ever
+        # being written to local disk.
+        tar_name = f"{backup_name}.tar.zst"
+        tar_cmd = ["tar", "-cf", "-"]
+        for f in file_paths:
+            tar_cmd += ["-C", str(Path(f).parent), Path(f).name]
+        zstd_cmd = ["/usr/bin/zstd", "-T0", "-3", "-q", "-c"]
+        tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+        assert tar.stdout is not None
+        zstd = subprocess.Popen(zstd_cmd, stdin=tar.stdout, stdout=subprocess.PIPE)
+        assert zstd.stdout is not None
+        tar.stdout.close()
+        blob = self.gcsbucket.blob(
+            str(Path(str(self.taskdate), tar_name)),
+            chunk_size=self.UPLOAD_CHUNK_SIZE,
+        )
+        try:
+            blob.upload_from_file(_PipeReader(zstd.stdout), rewind=False)
+        except BaseException:
+            # Nothing reads the pipeline's output anymore
+            for proc in (tar, zstd):
+                proc.kill()
+                proc.wait()
+            raise
+        finally:
+            zstd.stdout.close()
+
+        # A failed tar still ends the stream, so its partial upload is removed
+        if tar.wait() != 0 or zstd.wait() != 0:
+            blob.delete()
+            raise ConversionException(f"Failed to archive {tar_name}")
 
     def _get_roads_tags(self) -> Dict[str, Tuple[str, str]]:
         with open(self.osmium_config, "r") as f:
             config = json.load(f)
             return config["road_tags"]
 
+    def _download_range(
+        self,
+        url: str,
+        validator: str,
+        fd: int,
+        start: int,
+        end: int,
+        stop: threading.Event,
+    ):
+        # If the file changed since the HEAD request, If-Range makes the server
+        # answer with the whole new file instead of a range of it
+        headers = {"Range": f"bytes={start}-{end}", "If-Range": validator}
+        with requests.get(
+            url, headers=headers, stream=True, timeout=self.DOWNLOAD_TIMEOUT
+        ) as r:
+            r.raise_for_status()
+            if r.status_code != requests.codes.partial_content:
+                raise ValueError(
+                    f"Range request for {url} was not honored, or the file changed"
+                )
+
+            offset = start
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                # Another range failed, so the download is abandoned
+                if stop.is_set():
+                    return
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+
+        if offset != end + 1:
+            raise ValueError(f"Incomplete download of bytes {start}-{end} from {url}")
+
     # Step 1  ~40 mins
     def download_osm(self, osm_url: str, osm_file_path: Union[str, Path]) -> Path:
-        with requests.get(osm_url, stream=True) as r:
-            with open(osm_file_path, "wb") as f:
-                shutil.copyfileobj(r.raw, f)
+        r = requests.head(osm_url, allow_redirects=True, timeout=self.DOWNLOAD_TIMEOUT)
+        size = int(r.headers.get("Content-Length") or 0)
+        validator = _range_validator(r.headers)
+        if r.headers.get("Accept-Ranges") != "bytes" or size == 0 or not validator:
+            with requests.get(osm_url, stream=True, timeout=self.DOWNLOAD_TIMEOUT) as r:
+                # r.raw skips requests' content decoding unless asked for it
+                r.raw.decode_content = True
+                with open(osm_file_path, "wb") as f:
+                    shutil.copyfileobj(r.raw, f, 8 * 1024 * 1024)
+
+            return Path(osm_file_path)
+
+        # Fetch byte ranges over parallel connections, each written in place
+        part_size = math.ceil(size / self.DOWNLOAD_CONNECTIONS)
+        fd = os.open(osm_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            # Reserve the whole file up front so the out of order range writes
+            # neither fragment it nor run out of disk space halfway through
+            os.posix_fallocate(fd, 0, size)
+            stop = threading.Event()
+            with ThreadPoolExecutor(max_workers=self.DOWNLOAD_CONNECTIONS) as executor:
+                futures = [
+                    executor.submit(
+                        self._download_range,
+                        r.url,
+                        validator,
+                        fd,
+                        start,
+                        min(start + part_size, size) - 1,
+                        stop,
+                    )
+                    for start in range(0, size, part_size)
+                ]
+                try:
+                    _wait_for_all(futures)
+                except BaseException:
+                    # Stop the other ranges instead of waiting for them all
+                    stop.set()
+                    raise
+        finally:
+            os.close(fd)
 
         return Path(osm_file_path)
 
@@ -280,7 +612,28 @@ class HIIOSMRasterize(HIITask):
     def osm_to_txt(
         self, osm_file_path: Union[str, Path], txt_file_path: Union[str, Path]
     ) -> Path:
+        # Keeping only the objects with an exported tag (and the nodes and ways
+        # they reference) in one pass first means that export only has to index
+        # and assemble a fraction of the planet.
+        file_stem = os.path.splitext(txt_file_path)[0]
+        expressions_path = Path(f"{file_stem}-tags.txt")
+        filtered_path = Path(f"{file_stem}-filtered.osm.pbf")
+        with open(self.osmium_config, "r") as f:
+            include_tags = json.load(f)["include_tags"]
+        with open(expressions_path, "w") as f:
+            f.write("\n".join(include_tags) + "\n")
+
         try:
+            cmd = [
+                "/usr/bin/osmium",
+                "tags-filter",
+                f"-e {expressions_path}",
+                "-O",
+                f"-o {filtered_path}",
+                str(osm_file_path),
+            ]
+            subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+
             cmd = [
                 "/usr/bin/osmium",
                 "export",
@@ -288,13 +641,173 @@ class HIIOSMRasterize(HIITask):
                 f"-c {self.osmium_config}",
                 "-O",
                 f"-o {(txt_file_path)}",
-                str(osm_file_path),
+                str(filtered_path),
             ]
 
             subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
             return Path(txt_file_path)
         except subprocess.CalledProcessError as err:
             raise ConversionException(err.stdout)
+        finally:
+            for path in (expressions_path, filtered_path):
+                if path.exists():
+                    os.remove(path)
+
+    @classmethod
+    def _split_offsets(cls, txt_file: Union[str, Path], num_splits: int) -> List[int]:
+        # Byte offsets of num_splits contiguous ranges, snapped to row starts
+        size = os.path.getsize(txt_file)
+        offsets = [0]
+        with open(txt_file, "rb") as fr:
+            for n in range(1, num_splits):
+                fr.seek(max(size * n // num_splits, offsets[-1]))
+                fr.readline()
+                offsets.append(fr.tell())
+        offsets.append(size)
+
+        return offsets
+
+    @classmethod
+    def _split_text_range(  # noqa: C901
+        cls,
+        txt_file: Union[str, Path],
+        start: int,
+        end: int,
+        output_dir: Union[str, Path],
+        roads_file_path: Optional[Union[str, Path]],
+        roads_tags: Dict[str, Tuple[str, str]],
+    ) -> Dict[str, List[Tuple[Path, int]]]:
+        file_indices: Dict[bytes, int] = dict()
+        file_paths: Dict[bytes, Path] = dict()
+        file_handlers: Dict[bytes, BinaryIO] = dict()
+        # Rows are collected per attribute tag and written out in ~1 MiB blocks
+        buffers: Dict[bytes, List[bytes]] = dict()
+        buffer_sizes: Dict[bytes, int] = dict()
+
+        max_rows = cls.MAX_ROWS - 1
+        write_buffer_size = cls.WRITE_BUFFER_SIZE
+        _flush_buffer = cls._flush_buffer
+        _create_file = cls._create_file
+        # One uuid per range keeps file names unique across workers; the files
+        # of the range are then just numbered.
+        range_id = uuid.uuid4().hex
+        file_numbers = itertools.count()
+        # Split files of each attribute tag with their number of rows
+        output_files: Dict[str, List[Tuple[Path, int]]] = dict()
+        # Pre-encoded '","<attribute>","<tag>"\n' endings of the roads file rows;
+        # left empty when roads are not processed.
+        roads_suffixes: Dict[bytes, bytes] = dict()
+        # Road rows are cleaned and written in batches of ROADS_BATCH_SIZE rows
+        road_wkts: List[bytes] = []
+        road_row_suffixes: List[bytes] = []
+        roads_batch_size = cls.ROADS_BATCH_SIZE
+        if roads_file_path is not None:
+            roads_suffixes = {
+                k.encode(): f'","{v[0]}","{v[1]}"\n'.encode()
+                for k, v in roads_tags.items()
+            }
+            roads_file = open(roads_file_path, "wb")
+        for wkt, attribute_tags in cls._iter_parsed_rows(txt_file, start, end):
+            for attr_tag in attribute_tags:
+                if attr_tag not in file_handlers or file_indices[attr_tag] >= max_rows:
+                    tag_name = attr_tag.decode()
+                    if attr_tag in file_handlers:
+                        _flush_buffer(file_handlers[attr_tag], buffers[attr_tag])
+                        file_handlers[attr_tag].close()
+                        output_files.setdefault(tag_name, []).append(
+                            (file_paths[attr_tag], file_indices[attr_tag])
+                        )
+                    path, handle = _create_file(
+                        output_dir, tag_name, f"{range_id}-{next(file_numbers)}"
+                    )
+                    file_paths[attr_tag] = path
+                    file_handlers[attr_tag] = handle
+                    file_indices[attr_tag] = 0
+                    buffers[attr_tag] = []
+                    buffer_sizes[attr_tag] = 0
+
+                line = b'"' + wkt + b'",\n'
+                buffers[attr_tag].append(line)
+                buffer_sizes[attr_tag] += len(line)
+                file_indices[attr_tag] += 1
+                if buffer_sizes[attr_tag] >= write_buffer_size:
+                    _flush_buffer(file_handlers[attr_tag], buffers[attr_tag])
+                    buffer_sizes[attr_tag] = 0
+
+                road_suffix = roads_suffixes.get(attr_tag)
+                if road_suffix is not None:
+                    road_wkts.append(wkt)
+                    road_row_suffixes.append(road_suffix)
+                    if len(road_wkts) >= roads_batch_size:
+                        cls._write_roads(roads_file, road_wkts, road_row_suffixes)
+
+        for attr_tag, handle in file_handlers.items():
+            _flush_buffer(handle, buffers[attr_tag])
+            handle.close()
+            output_files.setdefault(attr_tag.decode(), []).append(
+                (file_paths[attr_tag], file_indices[attr_tag])
+            )
+        if roads_file_path is not None:
+            cls._write_roads(roads_file, road_wkts, road_row_suffixes)
+            roads_file.close()
+
+        return output_files
+
+    @classmethod
+    def _append_file(
+        cls, src_path: Union[str, Path], dst: BinaryIO, offset: int = 0
+    ) -> None:
+        # Copy from offset on within the kernel, without passing the data
+        # through Python; dst must have been flushed.
+        with open(src_path, "rb") as src:
+            size = os.fstat(src.fileno()).st_size
+            while offset < size:
+                offset += os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+
+    @classmethod
+    def _group_split_files(
+        cls, split_files: List[Tuple[Path, int]]
+    ) -> List[List[Path]]:
+        # Consecutive split files in groups of up to MAX_ROWS - 1 rows
+        groups: List[List[Path]] = [[]]
+        group_rows = 0
+        for path, rows in split_files:
+            if group_rows + rows > cls.MAX_ROWS - 1:
+                groups.append([])
+                group_rows = 0
+            groups[-1].append(path)
+            group_rows += rows
+
+        return [group for group in groups if group]
+
+    @classmethod
+    def _merge_split_files(
+        cls,
+        output_dir: Union[str, Path],
+        attributes_tag: str,
+        split_files: List[Tuple[Path, int]],
+    ) -> List[Path]:
+        # Every range writes its own split file of each tag, so rare tags end up
+        # in many tiny files. These are concatenated into files of up to
+        # MAX_ROWS rows, which keeps the split files and the layers of each
+        # rasterized VRT few; larger split files are kept as they are.
+        paths = [path for path, rows in split_files if rows >= cls.MERGE_MAX_ROWS]
+        small_files = [
+            (p, rows) for p, rows in split_files if rows < cls.MERGE_MAX_ROWS
+        ]
+        for n, group in enumerate(cls._group_split_files(small_files)):
+            if len(group) == 1:
+                paths.append(group[0])
+                continue
+            path, handle = cls._create_file(output_dir, attributes_tag, f"merged-{n}")
+            with handle:
+                handle.flush()
+                for src_path in group:
+                    cls._append_file(src_path, handle, len(cls.SPLIT_FILE_HEADER))
+                    os.remove(src_path)
+            paths.append(path)
+
+        return paths
 
     # Step 3  ~2 hrs
     def split_osmium_text_file(  # noqa: C901
@@ -303,101 +816,142 @@ class HIIOSMRasterize(HIITask):
         output_dir: Union[str, Path],
         roads_file_path: Union[str, Path],
         roads_tags: Dict[str, Tuple[str, str]],
-    ) -> Tuple[List[Path], Path]:
-        file_indices: Dict[str, int] = dict()
-        file_handlers = dict()
-
-        if Path(output_dir).exists() is False:
-            Path(output_dir).mkdir(exist_ok=True)
-
-        geod = Geod(ellps="WGS84")
-        max_rows = self.MAX_ROWS - 1
-        _parse_row = self._parse_row
-        _create_file = self._create_file
-        output_files = []
-        if self.process_roads:
-            roads_file = open(roads_file_path, "w")
-            roads_file.write('"wkt","attribute","tag"\n')
-        with open(txt_file, "r") as fr:
-            for row in fr:
-                wkt, attribute_tags = _parse_row(row)
+    ) -> Tuple[Dict[str, List[Path]], Path]:
+        os.makedirs(output_dir, exist_ok=True)
 
-                if wkt is None or attribute_tags is None:
-                    continue
+        # Rows are independent, so each worker splits its own byte range of the
+        # text file into its own split files and roads file part. Polygon rows
+        # are far slower to clean than the rest, so the file is cut into more
+        # ranges than workers to keep the pool busy until the end.
+        num_cpus = multiprocessing.cpu_count() - 1 or 1
+        num_ranges = num_cpus * self.SPLIT_RANGES_PER_WORKER
+        offsets = self._split_offsets(txt_file, num_ranges)
+        roads_file_parts: List[Path] = []
+        if self.process_roads:
+            roads_file_parts = [
+                Path(output_dir, f"roads-{n}-{uuid.uuid4()}.csv")
+                for n in range(num_ranges)
+            ]
 
-                for attr_tag in attribute_tags:
-                    if (
-                        attr_tag not in file_handlers
-                        or file_indices[attr_tag] >= max_rows
-                    ):
-                        path, handle = _create_file(output_dir, attr_tag)
-                        output_files.append(path)
-                        file_handlers[attr_tag] = handle
-                        file_indices[attr_tag] = 0
-
-                    file_handlers[attr_tag].write(f'"{wkt}",\n')
-                    file_indices[attr_tag] += 1
-
-                    if self.process_roads and attr_tag in roads_tags:
-                        rd_attr_tag = roads_tags[attr_tag]
-                        wkt = self._clean_geometry(wkt, geod)
-                        if wkt is not None:
-                            roads_file.write(
-                                f'"{wkt}","{rd_attr_tag[0]}","{rd_attr_tag[1]}"\n'
-                            )
+        # Split files of each attribute tag, across all ranges
+        split_files: Dict[str, List[Tuple[Path, int]]] = dict()
+        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            results = executor.map(
+                self._split_text_range,
+                itertools.repeat(txt_file),
+                offsets[:-1],
+                offsets[1:],
+                itertools.repeat(output_dir),
+                roads_file_parts if self.process_roads else itertools.repeat(None),
+                itertools.repeat(roads_tags),
+            )
+            for range_split_files in results:
+                for attribute_tag, files in range_split_files.items():
+                    split_files.setdefault(attribute_tag, []).extend(files)
+
+        with ThreadPoolExecutor(max_workers=num_cpus) as executor:
+            merged_files = executor.map(
+                self._merge_split_files,
+                itertools.repeat(output_dir),
+                split_files.keys(),
+                split_files.values(),
+            )
+            output_files = dict(zip(split_files.keys(), merged_files))
 
         if self.process_roads:
-            roads_file.close()
+            with open(roads_file_path, "wb") as roads_file:
+                roads_file.write(b'"wkt","attribute","tag"\n')
+                roads_file.flush()
+                for roads_file_part in roads_file_parts:
+                    self._append_file(roads_file_part, roads_file)
+                    os.remove(roads_file_part)
 
         return output_files, Path(roads_file_path)
 
     # Step 4  ~7 hrs
     def rasterize(
-        self, csv_files: List[Union[str, Path]], output_dir: Union[str, Path]
-    ) -> List[Path]:
-        if Path(output_dir).exists() is False:
-            Path(output_dir).mkdir(exist_ok=True)
+        self,
+        tag_csv_files: Dict[str, List[Path]],
+        output_dir: Union[str, Path],
+    ) -> Dict[str, Path]:
+        os.makedirs(output_dir, exist_ok=True)
 
-        output_files = [
-            Path(output_dir, f"{Path(os.path.splitext(f)[0]).name}.tif")
-            for f in csv_files
-        ]
+        # One image per attribute tag, burned from all of that tag's CSV files
+        output_files = {
+            attribute_tag: Path(output_dir, f"{attribute_tag}_{uuid.uuid4()}.tif")
+            for attribute_tag in tag_csv_files
+        }
 
         bounds = self.bounds
         num_cpus = multiprocessing.cpu_count() - 1 or 1
-        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
-            results = executor.map(
-                _rasterize, csv_files, output_files, itertools.repeat(bounds)
+        with ProcessPoolExecutor(
+            max_workers=num_cpus,
+            initializer=_init_gdal,
+            initargs=(_worker_cache_size(num_cpus), num_cpus),
+        ) as executor:
+            # Largest tags first so that no long job starts near the end
+            jobs = sorted(
+                zip(tag_csv_files.values(), output_files.values()),
+                key=lambda job: sum(os.path.getsize(f) for f in job[0]),
+                reverse=True,
             )
-            # TODO: this doesn't seem to raise an exception if one of the rasterizations fails
-            for result in results:
-                if isinstance(result, Exception):
-                    raise result
+            futures = [
+                executor.submit(
+                    _rasterize, in_files, output_file, bounds, self.STACK_WINDOW
+                )
+                for in_files, output_file in jobs
+            ]
+            _wait_for_all(futures)
 
         return output_files
 
     # Step 5  ~1 hr
     def stack_images(
-        self, image_paths: List[Union[str, Path]], output_dir: Union[str, Path]
+        self,
+        image_paths: Sequence[Union[str, Path]],
+        output_dir: Union[str, Path],
+        on_stacked: Optional[Callable[[Path], Any]] = None,
     ) -> List[Path]:
 
-        num_cpus = math.ceil((multiprocessing.cpu_count() - 1) / 2.0) or 1
-        output_image_paths = [
-            Path(output_dir, f"stacked-{n+1}.tif") for n in range(num_cpus)
-        ]
+        # GDAL compresses blocks on several threads per worker, so fewer
+        # worker processes are needed to keep all cores busy.
+        num_cpus = multiprocessing.cpu_count() - 1 or 1
+        num_workers = math.ceil(num_cpus / 4.0)
+        num_threads = num_cpus // num_workers or 1
+        # A VRT with one band per image lets each worker read all bands of a
+        # window in a single call through one dataset and block cache.
+        vrt_path = Path(output_dir, "stacked.vrt")
+        vrt = gdal.BuildVRT(str(vrt_path), [str(p) for p in image_paths], separate=True)
+        if vrt is None:
+            raise ConversionException(f"Failed to build {vrt_path}")
+        # Closing the dataset writes the VRT to disk for the strip workers
+        vrt = None
+        # Dense and empty (ocean) strips take very different times, so there
+        # are more strips than workers to keep the pool busy until the end.
         img_stack_metas = raster_utils.split_image(
-            image_paths, num_cpus, window_size=1024
+            vrt_path,
+            num_workers * self.STACK_SPLITS_PER_WORKER,
+            window_size=self.STACK_WINDOW,
         )
+        output_image_paths = [
+            Path(output_dir, f"stacked-{n+1}.tif") for n in range(len(img_stack_metas))
+        ]
 
-        with ProcessPoolExecutor(max_workers=num_cpus) as executor:
-            results = executor.map(
-                raster_utils.stack_images,
-                img_stack_metas,
-                output_image_paths,
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Widest strips first; only the last one can be narrower
+            jobs = sorted(
+                zip(img_stack_metas, output_image_paths),
+                key=lambda job: job[0].profile["width"] * job[0].profile["height"],
+                reverse=True,
             )
-            for result in results:
-                if isinstance(result, Exception):
-                    raise result
+            futures = [
+                executor.submit(
+                    raster_utils.stack_images, meta, output_image_path, num_threads
+                )
+                for meta, output_image_path in jobs
+            ]
+            # Each strip is handed on as soon as it is written
+            _wait_for_all(futures, on_stacked)
 
         return output_image_paths
 
@@ -407,12 +961,47 @@ class HIIOSMRasterize(HIITask):
     ) -> str:
         targ_name = name or Path(src_path).name
         targ_path = Path(str(self.taskdate), targ_name)
-        return super().upload_to_cloudstorage(src_path, targ_path)
+        if os.path.getsize(src_path) <= self.UPLOAD_CHUNK_SIZE:
+            return super().upload_to_cloudstorage(src_path, targ_path)
+
+        # Large files are uploaded as concurrent parts of one XML multipart upload
+        blob = self.gcsbucket.blob(str(targ_path))
+        transfer_manager.upload_chunks_concurrently(
+            str(src_path),
+            blob,
+            chunk_size=self.UPLOAD_CHUNK_SIZE,
+            max_workers=self.UPLOAD_WORKERS,
+            worker_type=transfer_manager.THREAD,
+        )
+        return f"gs://{self.gcsbucket.name}/{targ_path}"
 
     # Step 7
     def cleanup_working_files(self):
         print("Not Implemented")
 
+    def _stack_and_upload(
+        self, image_paths: List[Path], road_file_path: Path
+    ) -> Tuple[List[str], str]:
+        # Strips are uploaded while the rest are still being stacked, and
+        # large files each in concurrent parts
+        image_uploads: Dict[Path, Future] = dict()
+        with ThreadPoolExecutor(max_workers=self.UPLOAD_WORKERS) as executor:
+            if self.process_roads:
+                road_upload = executor.submit(
+                    self.upload_to_cloudstorage, road_file_path
+                )
+
+            def upload_stacked(path: Path):
+                image_uploads[path] = executor.submit(self.upload_to_cloudstorage, path)
+
+            stacked_images = self.stack_images(
+                image_paths, self._working_directory, upload_stacked
+            )
+            image_uris = [image_uploads[p].result() for p in stacked_images]
+            road_text_uri = road_upload.result() if self.process_roads else ""
+
+        return image_uris, road_text_uri
+
     def calc(self):
         roads_tags = self._get_roads_tags()
 
@@ -455,17 +1044,12 @@ class HIIOSMRasterize(HIITask):
                 csv_files, Path(self._working_directory, "images")
             )
 
-        with Timer("Many images to multi-bands image"):
-            stacked_images = self.stack_images(image_paths, self._working_directory)
-
-        with Timer("Upload tiff to GS"):
-            image_uris = []
-            road_text_uri = ""
-            for stacked_image in stacked_images:
-                image_uris.append(self.upload_to_cloudstorage(stacked_image))
-            if self.process_roads:
-                road_text_uri = self.upload_to_cloudstorage(road_file_path)
+        with Timer("Stack images and upload tiffs to GS"):
+            image_uris, road_text_uri = self._stack_and_upload(
+                list(image_paths.values()), road_file_path
+            )
 
+        with Timer("Upload metadata to GS"):
             metadata_file = self._create_image_metadata(
                 image_paths,
                 image_uris,